@@ -4,21 +4,64 @@ import sqlite3
 import re
 import json
 import csv
+import heapq
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
 from datetime import datetime, timezone
 
 EMAIL_RE = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b")
 UUID_RE = re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[1-5][0-9a-fA-F]{3}-[89abAB][0-9a-fA-F]{3}-[0-9a-fA-F]{12}\b")
 ISO8601_RE = re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:\d{2})?)?\b")
+# Single pass that rules out values with neither an email nor a UUID
+IDENT_RE = re.compile(f"{EMAIL_RE.pattern}|{UUID_RE.pattern}")
+# Every email contains '@' and every UUID/phone a digit; rows without either never leave SQLite.
+# GLOB runs in SQLite's own matcher, no Python callback per row.
+IDENT_CANDIDATE_GLOB = "*[0-9@]*"
+NON_DIGIT_RE = re.compile(r"\D")
+DIGIT_RE = re.compile(r"\d")
+# Keyword(s) must start a name segment, and "id" must either follow a keyword directly
+# ("userid", "touserid") or start its own segment ("_id", camelCase "Id"/"ID"), so e.g.
+# "total_paid", "user_paid", "sender_uuid" or "tokenid" are not taken for link columns.
+# Segments start at "_" or at a lower->Upper step ("fromUserId"), hence no re.I on the whole pattern.
+ID_COL_RE = re.compile(r"(?:^|_|(?<=[a-z])(?=[A-Z]))(?i:user|sender|from|src|author|owner|recipient|to|dst|peer)+"
+                       r"(?:(?i:id)|(?:_\w*|(?<=[a-z])[A-Z]\w*)?(?:_[iI][dD]|(?<=[a-z])I[dD]))$")
 
 # Heuristic column name hints
-TEXT_EMAIL_HINTS = {"email", "e_mail", "mail"}
-TEXT_PHONE_HINTS = {"phone", "tel", "mobile", "msisdn"}
-TEXT_UUID_HINTS = {"uuid", "guid"}
-TIME_HINTS = {"time", "timestamp", "ts", "date", "datetime", "created_at", "updated_at"}
+TEXT_EMAIL_HINTS = frozenset({"email", "e_mail", "mail"})
+TEXT_PHONE_HINTS = frozenset({"phone", "tel", "mobile", "msisdn"})
+TEXT_UUID_HINTS = frozenset({"uuid", "guid"})
+TIME_HINTS = frozenset({"time", "timestamp", "ts", "date", "datetime", "created_at", "updated_at"})
+
+def _hint_re(hints):
+    # One case-insensitive alternation instead of a substring test per hint
+    return re.compile("|".join(re.escape(h) for h in sorted(hints)), re.I)
+
+TEXT_EMAIL_HINT_RE = _hint_re(TEXT_EMAIL_HINTS)
+TEXT_PHONE_HINT_RE = _hint_re(TEXT_PHONE_HINTS)
+TEXT_UUID_HINT_RE = _hint_re(TEXT_UUID_HINTS)
+TIME_HINT_RE = _hint_re(TIME_HINTS)
+
+@lru_cache(maxsize=None)
+def _compile(pattern):
+    return re.compile(pattern)
+
+def _regexp(pattern, value):
+    # Backs SQLite's "X REGEXP Y" operator, which calls regexp(Y, X)
+    if value is None:
+        return 0
+    return 1 if _compile(pattern).search(str(value)) else 0
 
 def connect(db_path):
-    conn = sqlite3.connect(db_path)
+    # Read-only: never modify evidence. Not immutable=1, which would ignore un-checkpointed WAL content.
+    conn = sqlite3.connect(Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
     conn.row_factory = sqlite3.Row
+    # Full-table scans: memory-map the file and keep a large page cache
+    for pragma in ("mmap_size=1073741824", "cache_size=-262144", "temp_store=MEMORY"):
+        conn.execute(f"PRAGMA {pragma}")
+    conn.create_function("regexp", 2, _regexp, deterministic=True)
     return conn
 
 def get_tables(conn):
@@ -26,32 +69,52 @@ def get_tables(conn):
     return [r[0] for r in cur.fetchall()]
 
 def get_table_info(conn, table):
-    # PRAGMA table_info returns: cid, name, type, notnull, dflt_value, pk
-    cur = conn.execute(f"PRAGMA table_info('{table}')")
+    # pragma_table_info returns: cid, name, type, notnull, dflt_value, pk
+    # Bound parameter: one cached statement for every table, safe for any table name
+    cur = conn.execute("SELECT * FROM pragma_table_info(?)", (table,))
     cols = [dict(row) for row in cur.fetchall()]
     # Normalize type names
     for c in cols:
         t = (c["type"] or "").upper()
         c["type_norm"] = "TEXT" if "CHAR" in t or "TEXT" in t or "CLOB" in t else ("INT" if "INT" in t else ("REAL" if "REAL" in t or "FLOA" in t or "DOUB" in t else t))
+        # Name hints, classified once here so extractors just read flags
+        c["is_time"] = looks_like_time_column(c["name"])
+        c["is_email"] = looks_like_email_column(c["name"])
+        c["is_phone"] = looks_like_phone_column(c["name"])
     return cols
 
+def quote_ident(name):
+    # SQL identifier quoting: safe for spaces, quotes and keywords in table/column names
+    return '"' + name.replace('"', '""') + '"'
+
 def pk_expression(table, cols):
     pk_cols = [c["name"] for c in cols if c["pk"]]
     if len(pk_cols) == 1:
-        return pk_cols[0], "pk"
+        return quote_ident(pk_cols[0]), "pk"
     elif len(pk_cols) > 1:
         # Composite PK: concatenate with '|'
-        expr = " || '|' || ".join([f"CAST({c} AS TEXT)" for c in pk_cols])
+        expr = " || '|' || ".join([f"CAST({quote_ident(c)} AS TEXT)" for c in pk_cols])
         return expr, "composite_pk"
     else:
         # Fallback to ROWID (may not exist for WITHOUT ROWID tables)
         return "rowid", "rowid"
 
-def fetch_distinct(conn, table, col, rid_expr, limit=None):
-    lim = f" LIMIT {int(limit)}" if limit else ""
-    sql = f"SELECT {rid_expr} AS __rid__, {col} AS __val__ FROM '{table}' WHERE {col} IS NOT NULL{lim}"
+def fetch_candidates(conn, table, col, rid_expr, limit=None, pattern=None, glob=None):
+    # Non-NULL values (not distinct; duplicates are dropped at output). NULL filter, optional
+    # glob/regex and limit all run inside SQLite, so it stops producing rows once the limit is hit.
+    qcol = quote_ident(col)
+    cond, params = "", []
+    if glob:
+        cond += f" AND {qcol} GLOB ?"
+        params.append(glob)
+    if pattern:
+        cond += f" AND {qcol} REGEXP ?"
+        params.append(pattern)
+    sql = f"SELECT {rid_expr} AS __rid__, {qcol} AS __val__ FROM {quote_ident(table)} WHERE {qcol} IS NOT NULL{cond} LIMIT ?"
+    # Bound limit keeps the statement text constant; a negative LIMIT means no limit
+    params.append(int(limit) if limit else -1)
     try:
-        cur = conn.execute(sql)
+        cur = conn.execute(sql, params)
         for row in cur:
             yield row["__rid__"], row["__val__"]
     except sqlite3.OperationalError:
@@ -59,7 +122,7 @@ def fetch_distinct(conn, table, col, rid_expr, limit=None):
         pass
 
 def normalize_phone(s):
-    digits = re.sub(r"\D", "", s or "")
+    digits = NON_DIGIT_RE.sub("", s or "")
     if len(digits) < 10:
         return None
     # Keep last 15 digits max (E.164)
@@ -68,20 +131,19 @@ def normalize_phone(s):
     return "+" + digits if not s.strip().startswith("+") else "+" + digits
 
 def looks_like_time_column(name):
-    n = (name or "").lower()
-    return any(h in n for h in TIME_HINTS)
+    return TIME_HINT_RE.search(name or "") is not None
 
 def looks_like_email_column(name):
-    n = (name or "").lower()
-    return any(h in n for h in TEXT_EMAIL_HINTS)
+    return TEXT_EMAIL_HINT_RE.search(name or "") is not None
 
 def looks_like_phone_column(name):
-    n = (name or "").lower()
-    return any(h in n for h in TEXT_PHONE_HINTS)
+    return TEXT_PHONE_HINT_RE.search(name or "") is not None
 
 def looks_like_uuid_column(name):
-    n = (name or "").lower()
-    return any(h in n for h in TEXT_UUID_HINTS)
+    return TEXT_UUID_HINT_RE.search(name or "") is not None
+
+# Exclusive upper bound of the accepted epoch range: 2101-01-01T00:00:00Z
+EPOCH_MAX = 4_133_980_800
 
 def epoch_to_iso(ts):
     try:
@@ -91,105 +153,89 @@ def epoch_to_iso(ts):
         # Heuristic: ms vs s
         if ts > 1_000_000_000_000:  # likely ms
             ts = ts / 1000.0
-        dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-        # sanity range 1970–2100
-        if dt.year < 1970 or dt.year > 2100:
+        # sanity range 1970–2100, checked before building a datetime
+        if not 0 <= ts < EPOCH_MAX:
             return None
-        return dt.isoformat()
+        return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
     except Exception:
         return None
 
-def extract_identifiers(conn, table, cols, rid_expr):
-    results = []
+# One extracted fact. The first six fields are its identity; raw (the original integer) is only set for UnixEpoch.
+Record = namedtuple("Record", "entity_type subtype value table rowid column raw", defaults=(None,))
+
+def record_dict(r):
+    # Output field order; "raw" only when present
+    d = {"entity_type": r.entity_type, "subtype": r.subtype, "value": r.value}
+    if r.raw is not None:
+        d["raw"] = r.raw
+    d["table"], d["rowid"], d["column"] = r.table, r.rowid, r.column
+    return d
+
+def extract_identifiers(conn, table, cols, rid_expr, limit=None):
+    # Bound methods as locals: skips attribute lookups in the per-row loop
+    ident_search, has_digit = IDENT_RE.search, DIGIT_RE.search
+    find_emails, find_uuids = EMAIL_RE.findall, UUID_RE.findall
+    _str = str
     for c in cols:
         name = c["name"]
         t = c["type_norm"]
-        if t != "TEXT" and not looks_like_email_column(name) and not looks_like_phone_column(name):
+        is_phone = c["is_phone"]
+        if t != "TEXT" and not c["is_email"] and not is_phone:
             continue
-        for rid, val in fetch_distinct(conn, table, name, rid_expr):
-            s = str(val)
-            # Emails
-            for m in EMAIL_RE.findall(s):
-                results.append({
-                    "entity_type": "Identifier",
-                    "subtype": "Email",
-                    "value": m,
-                    "table": table,
-                    "rowid": str(rid),
-                    "column": name
-                })
-            # UUIDs
-            for m in UUID_RE.findall(s):
-                results.append({
-                    "entity_type": "Identifier",
-                    "subtype": "UUID",
-                    "value": m.lower(),
-                    "table": table,
-                    "rowid": str(rid),
-                    "column": name
-                })
+        for rid, val in fetch_candidates(conn, table, name, rid_expr, limit, glob=IDENT_CANDIDATE_GLOB):
+            # TEXT values are already str; only coerce the rest
+            s = val if val.__class__ is str else _str(val)
+            # Separate passes only on a hit, so UUIDs inside emails are still reported
+            if ident_search(s):
+                rid = rid if rid.__class__ is str else _str(rid)
+                # Emails
+                for m in find_emails(s):
+                    yield Record("Identifier", "Email", m, table, rid, name)
+                # UUIDs
+                for m in find_uuids(s):
+                    yield Record("Identifier", "UUID", m.lower(), table, rid, name)
             # Phones
-            norm = normalize_phone(s) if (looks_like_phone_column(name) or re.search(r"\d", s)) else None
+            norm = normalize_phone(s) if (is_phone or has_digit(s)) else None
             if norm:
-                results.append({
-                    "entity_type": "Identifier",
-                    "subtype": "Phone",
-                    "value": norm,
-                    "table": table,
-                    "rowid": str(rid),
-                    "column": name
-                })
-    return results
-
-def extract_temporal(conn, table, cols, rid_expr):
-    results = []
+                yield Record("Identifier", "Phone", norm, table, rid if rid.__class__ is str else _str(rid), name)
+
+def extract_temporal(conn, table, cols, rid_expr, limit=None):
+    _str = str
     for c in cols:
         name = c["name"]
         t = c["type_norm"]
-        # Integer-like: Unix seconds/ms
-        if t == "INT" or looks_like_time_column(name):
-            for rid, val in fetch_distinct(conn, table, name, rid_expr):
+        is_time = c["is_time"]
+        want_epoch = t == "INT" or is_time  # Integer-like: Unix seconds/ms
+        want_iso = t == "TEXT" or is_time   # Text ISO-8601
+        if not (want_epoch or want_iso):
+            continue
+        # One scan per column. The ISO match is pushed into SQLite unless the epoch check needs every row.
+        pattern = None if want_epoch else ISO8601_RE.pattern
+        iso_results = []
+        for rid, val in fetch_candidates(conn, table, name, rid_expr, limit, pattern):
+            if want_epoch:
                 try:
                     iso = epoch_to_iso(int(val))
                     if iso:
-                        results.append({
-                            "entity_type": "Temporal",
-                            "subtype": "UnixEpoch",
-                            "value": iso,
-                            "raw": str(val),
-                            "table": table,
-                            "rowid": str(rid),
-                            "column": name
-                        })
+                        yield Record("Temporal", "UnixEpoch", iso, table, rid if rid.__class__ is str else _str(rid), name, _str(val))
                 except Exception:
                     pass
-        # Text ISO-8601
-        if t == "TEXT" or looks_like_time_column(name):
-            for rid, val in fetch_distinct(conn, table, name, rid_expr):
-                s = str(val)
-                if ISO8601_RE.search(s):
-                    results.append({
-                        "entity_type": "Temporal",
-                        "subtype": "ISO8601",
-                        "value": s,
-                        "table": table,
-                        "rowid": str(rid),
-                        "column": name
-                    })
-    return dedupe(results, keys=("entity_type","subtype","value","table","rowid","column"))
-
-def extract_relational(conn, table, cols, rid_expr):
+            if want_iso:
+                s = val if val.__class__ is str else _str(val)
+                if pattern or ISO8601_RE.search(s):
+                    rec = Record("Temporal", "ISO8601", s, table, rid if rid.__class__ is str else _str(rid), name)
+                    if want_epoch:
+                        iso_results.append(rec)
+                    else:
+                        yield rec
+        # Keep per-column order: epoch records first, then ISO (only buffered when both checks ran)
+        yield from iso_results
+
+def extract_relational(conn, table, cols, rid_expr, limit=None):
     # Simple heuristic: look for rows with two id-like columns that imply a link
     # e.g., sender_id + recipient_id, from_id + to_id, user_id + peer_user_id
-    id_cols = [c["name"] for c in cols if re.search(r"(?:^|_)(user|sender|from|src|author|owner|recipient|to|dst|peer).*_?id$", c["name"], re.I)]
-    results = []
+    id_cols = [c["name"] for c in cols if ID_COL_RE.search(c["name"])]
     if len(id_cols) >= 2:
-        # Try all ordered pairs
-        pairs = []
-        for a in id_cols:
-            for b in id_cols:
-                if a != b:
-                    pairs.append((a,b))
         # Sample the first plausible pair by name priority
         priority = ["sender", "from", "src", "author", "owner", "user"]
         recv_pri = ["recipient", "to", "dst", "peer", "user"]
@@ -199,83 +245,130 @@ def extract_relational(conn, table, cols, rid_expr):
                 if k in n:
                     return len(keys)-i
             return 0
-        pairs.sort(key=lambda ab: (score(ab[0], priority)+score(ab[1], recv_pri)), reverse=True)
+        # Score each column once per role; ties keep column order
+        send = {i: score(c, priority) for i, c in enumerate(id_cols)}
+        recv = {i: score(c, recv_pri) for i, c in enumerate(id_cols)}
+        # Any of the top 2 pairs uses one of the 3 best senders and one of the 3 best receivers
+        # (a column can be the other side of at most one better pair), so only those are paired
+        senders = heapq.nsmallest(3, send, key=lambda i: (-send[i], i))
+        receivers = heapq.nsmallest(3, recv, key=lambda i: (-recv[i], i))
+        best = heapq.nsmallest(2, ((a, b) for a in senders for b in receivers if a != b),
+                               key=lambda ab: (-(send[ab[0]] + recv[ab[1]]), ab))
         # Keep top 2 pairs to avoid explosion
-        pairs = pairs[:2]
+        pairs = [(id_cols[a], id_cols[b]) for a, b in best]
         for a,b in pairs:
-            sql = f"SELECT {rid_expr} AS __rid__, {a} AS __a__, {b} AS __b__ FROM '{table}' WHERE {a} IS NOT NULL AND {b} IS NOT NULL"
+            qa, qb = quote_ident(a), quote_ident(b)
+            sql = f"SELECT {rid_expr} AS __rid__, {qa} AS __a__, {qb} AS __b__ FROM {quote_ident(table)} WHERE {qa} IS NOT NULL AND {qb} IS NOT NULL LIMIT ?"
             try:
-                cur = conn.execute(sql)
+                cur = conn.execute(sql, (int(limit) if limit else -1,))
                 for row in cur:
                     va, vb = row["__a__"], row["__b__"]
-                    results.append({
-                        "entity_type": "Relational",
-                        "subtype": f"{a}->{b}",
-                        "value": f"{va}->{vb}",
-                        "table": table,
-                        "rowid": str(row["__rid__"]),
-                        "column": f"{a},{b}"
-                    })
+                    yield Record("Relational", f"{a}->{b}", f"{va}->{vb}", table, str(row["__rid__"]), f"{a},{b}")
             except sqlite3.OperationalError:
                 continue
-    return results
 
-def dedupe(items, keys):
+def extract_table(conn, table, targets, limit=None):
+    cols = get_table_info(conn, table)
+    rid_expr, rid_kind = pk_expression(table, cols)
+    if "identifier" in targets:
+        yield from extract_identifiers(conn, table, cols, rid_expr, limit)
+    if "temporal" in targets:
+        yield from extract_temporal(conn, table, cols, rid_expr, limit)
+    if "relational" in targets:
+        yield from extract_relational(conn, table, cols, rid_expr, limit)
+
+def process_table(db_path, table, targets, limit=None):
+    # Worker entry point: private read-only connection, whole table materialized for the parent
+    conn = connect(db_path)
+    try:
+        return list(extract_table(conn, table, targets, limit))
+    finally:
+        conn.close()
+
+def process_tables(pool, window, db_path, tables, targets, limit=None):
+    # At most `window` tables in flight; results come back in table order, each one released
+    # as soon as the writer has consumed it, so memory stays bounded by the window, not the DB
+    pending = deque()
+    for table in tables:
+        pending.append(pool.submit(process_table, db_path, table, targets, limit))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def unique_records(records):
+    # Drop records whose (entity_type, subtype, value, table, rowid, column) was already seen; first occurrence wins
     seen = set()
-    out = []
-    for it in items:
-        k = tuple(it.get(k) for k in keys)
-        if k in seen:
+    for rec in records:
+        key = rec[:6]
+        if key in seen:
             continue
-        seen.add(k)
-        out.append(it)
-    return out
+        seen.add(key)
+        yield rec
 
 def write_output(records, out_path, fmt):
+    # records may be any iterable; JSON/NDJSON are written one record at a time. Returns the record count.
+    n = 0
     if fmt == "json":
+        # Same bytes as json.dump(list, indent=2), without building the whole document in memory
         with open(out_path, "w", encoding="utf-8") as f:
-            json.dump(records, f, ensure_ascii=False, indent=2)
+            for r in records:
+                f.write(",\n  " if n else "[\n  ")
+                f.write(json.dumps(r, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+                n += 1
+            f.write("\n]" if n else "[]")
+    elif fmt == "ndjson":
+        with open(out_path, "w", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r, ensure_ascii=False))
+                f.write("\n")
+                n += 1
     elif fmt == "csv":
+        # Header is the union of all keys, so CSV needs the full list
+        records = list(records)
         if not records:
             with open(out_path, "w", newline="", encoding="utf-8") as f:
                 f.write("")
-            return
+            return 0
         fields = sorted({k for r in records for k in r.keys()})
         with open(out_path, "w", newline="", encoding="utf-8") as f:
             w = csv.DictWriter(f, fieldnames=fields)
             w.writeheader()
             w.writerows(records)
+        n = len(records)
     else:
         raise ValueError("Unsupported format")
+    return n
 
 def main():
     ap = argparse.ArgumentParser(description="Extract ground truth (value + Table + RowID/PK) from a SQLite database.")
     ap.add_argument("db", help="Path to SQLite DB")
     ap.add_argument("--entities", default="all", help="Comma list: identifier,temporal,relational or 'all'")
-    ap.add_argument("--out", default="ground_truth.json", help="Output file path (.json or .csv)")
-    ap.add_argument("--limit", type=int, default=None, help="Optional per-column scan limit")
+    ap.add_argument("--out", default="ground_truth.json", help="Output file path (.json, .ndjson/.jsonl or .csv)")
+    ap.add_argument("--limit", type=int, default=None, help="Optional per-column limit on rows read (after NULL/pattern filtering)")
+    ap.add_argument("--workers", type=int, default=1, help="Processes extracting tables in parallel (default 1: serial); "
+                    "each in-flight table's records are held in memory until written")
     args = ap.parse_args()
 
-    fmt = "json" if args.out.lower().endswith(".json") else ("csv" if args.out.lower().endswith(".csv") else "json")
+    out = args.out.lower()
+    fmt = "csv" if out.endswith(".csv") else ("ndjson" if out.endswith((".ndjson", ".jsonl")) else "json")
     targets = set(e.strip().lower() for e in args.entities.split(",")) if args.entities != "all" else {"identifier","temporal","relational"}
 
     conn = connect(args.db)
-    all_records = []
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
     try:
-        for table in get_tables(conn):
-            cols = get_table_info(conn, table)
-            rid_expr, rid_kind = pk_expression(table, cols)
-            if "identifier" in targets:
-                all_records.extend(extract_identifiers(conn, table, cols, rid_expr))
-            if "temporal" in targets:
-                all_records.extend(extract_temporal(conn, table, cols, rid_expr))
-            if "relational" in targets:
-                all_records.extend(extract_relational(conn, table, cols, rid_expr))
-        # Ensure unique and stable
-        all_records = dedupe(all_records, keys=("entity_type","subtype","value","table","rowid","column"))
-        write_output(all_records, args.out, fmt)
-        print(f"Wrote {len(all_records)} records to {args.out}")
+        tables = get_tables(conn)
+        if pool:
+            # Table order is kept, so output matches a serial run
+            records = chain.from_iterable(process_tables(pool, 2 * args.workers, args.db, tables, targets, args.limit))
+        else:
+            records = (rec for table in tables for rec in extract_table(conn, table, targets, args.limit))
+        # Ensure unique and stable; records stream straight into the writer
+        n = write_output(map(record_dict, unique_records(records)), args.out, fmt)
+        print(f"Wrote {n} records to {args.out}")
     finally:
+        if pool:
+            pool.shutdown()
         conn.close()
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
 import google.generativeai as genai
 import sqlite3
 import json
+import threading
 import os
 import time
 from datetime import datetime
+from pathlib import Path
 
 # --- CONFIGURATION ---
 API_KEY = "YOUR_GEMINI_API_KEY" # Replace this
@@ -14,10 +16,22 @@ LOG_DIR = "experiment_logs"
 genai.configure(api_key=API_KEY)
 
 # --- HELPER: Fix JSON Serialization Error (Updated) ---
+_PRIMITIVES = (int, float, bool, type(None), str)
+_PRIMITIVE_TYPES = frozenset(_PRIMITIVES)
+
 def make_serializable(obj):
     """Recursively converts Google's internal Protobuf types to standard dicts/lists."""
-    # 1. Handle Primitive Types (Int, Float, Bool, None, Str)
-    if isinstance(obj, (int, float, bool, type(None), str)):
+    # Exact-type checks first: one set/identity test for the common cases
+    t = type(obj)
+    if t in _PRIMITIVE_TYPES:
+        return obj
+    if t is dict:
+        return {k: make_serializable(v) for k, v in obj.items()}
+    if t is list or t is tuple:
+        return [make_serializable(x) for x in obj]
+
+    # 1. Handle Primitive Types (Int, Float, Bool, None, Str), incl. subclasses such as enums
+    if isinstance(obj, _PRIMITIVES):
         return obj
     
     # 2. Handle Dict-like objects (MapComposite)
@@ -50,24 +64,60 @@ def make_serializable(obj):
 #         except (ValueError, TypeError):
 #             return str(obj)
 
+# --- HELPER: Read-only authorizer ---
+# SQLite asks this for every action while compiling a statement, so writes are
+# rejected at parse time instead of by keyword matching on the query text.
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+# Pragmas whose argument only names a table/index to describe
+_ALLOWED_PRAGMAS = {"table_info", "table_xinfo", "table_list", "index_list", "index_info", "index_xinfo", "foreign_key_list"}
+# Introspection pragmas, allowed only in their query form (no "= value")
+_READ_PRAGMAS = {"database_list", "user_version", "schema_version", "application_id", "journal_mode", "encoding",
+                 "page_size", "page_count", "freelist_count", "foreign_keys", "collation_list", "function_list",
+                 "module_list", "pragma_list", "compile_options"}
+# Denied actions that change nothing; reported as "not permitted" rather than destructive
+_NON_WRITE_ACTIONS = {sqlite3.SQLITE_PRAGMA, sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH,
+                      sqlite3.SQLITE_TRANSACTION, sqlite3.SQLITE_SAVEPOINT}
+_DENIAL = threading.local()  # .write: whether the last denial on this thread was a write
+
+def _authorize(action, arg1, arg2, db_name, trigger):
+    if action in _ALLOWED_ACTIONS:
+        return sqlite3.SQLITE_OK
+    pragma = (arg1 or "").lower() if action == sqlite3.SQLITE_PRAGMA else None
+    if pragma in _ALLOWED_PRAGMAS or (pragma in _READ_PRAGMAS and arg2 is None):
+        return sqlite3.SQLITE_OK
+    # pragma_table_info() & co. request this while preparing; the connection is mode=ro anyway
+    if action == sqlite3.SQLITE_UPDATE and arg1 == "sqlite_master":
+        return sqlite3.SQLITE_OK
+    # Setting a pragma value counts as a write
+    _DENIAL.write = action not in _NON_WRITE_ACTIONS or (pragma is not None and arg2 is not None)
+    return sqlite3.SQLITE_DENY
+
+# --- HELPER: Shared read-only connection ---
+_CONN = None
+
+def get_connection():
+    """Opens DB_PATH read-only on first use and reuses it for every tool call."""
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(Path(DB_PATH).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        # Keep pages cached/mapped between tool calls
+        _CONN.execute("PRAGMA mmap_size=268435456")
+        _CONN.execute("PRAGMA cache_size=-65536")
+        _CONN.set_authorizer(_authorize)
+    return _CONN
+
 # Define the Tool (Non-destructive SQL)
 def execute_sqlite_query(query):
     """Executes a read-only SQL query on the target database."""
-    # Safety: Prevent modification commands
-    if any(x in query.lower() for x in ['drop', 'delete', 'insert', 'update', 'alter']):
-        return {"error": "Destructive commands are prohibited."}
-    
     try:
         # Check if DB exists
         if not os.path.exists(DB_PATH):
             return {"error": f"Database file not found at {DB_PATH}"}
 
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(query)
+        _DENIAL.write = True
+        cursor = get_connection().execute(query)
         rows = cursor.fetchall()
         columns = [description[0] for description in cursor.description]
-        conn.close()
         
         # Return formatted results as a structured dict
         # Limit to 20 rows to avoid token overflow
@@ -76,6 +126,13 @@ def execute_sqlite_query(query):
             "row_count": len(rows),
             "data": rows[:20]
         }
+    except sqlite3.DatabaseError as e:
+        # Safety: anything beyond reads is refused by _authorize
+        if str(e) == "not authorized":
+            if _DENIAL.write:
+                return {"error": "Destructive commands are prohibited."}
+            return {"error": "Statement not permitted: only SELECT and read-only PRAGMA queries are allowed."}
+        return {"error": str(e)}
     except Exception as e:
         return {"error": str(e)}
 
@@ -114,31 +171,34 @@ def run_agent_trial(workflow_name, system_prompt, user_query, trial_id):
 
     # EXTRACT HISTORY FOR LOGGING
     # We iterate through the chat history to capture Thoughts vs Tools
+    add_step = session_log["steps"].append
     for message in chat.history:
         role = message.role
         for part in message.parts:
             step_data = {"role": role}
+            # Each proto field is read once; every access goes through a descriptor
+            text, call, resp = part.text, part.function_call, part.function_response
             
             # 1. Capture Text (Reasoning/Planning)
-            if part.text:
+            if text:
                 step_data["type"] = "reasoning"
-                step_data["content"] = part.text.strip()
+                step_data["content"] = text.strip()
             
             # 2. Capture Function Calls (Tool Use)
-            if part.function_call:
+            if call:
                 step_data["type"] = "tool_execution"
-                step_data["tool_name"] = part.function_call.name
+                step_data["tool_name"] = call.name
                 # FIX: Convert MapComposite to standard dict
-                step_data["tool_args"] = make_serializable(part.function_call.args)
+                step_data["tool_args"] = make_serializable(call.args)
                 
             # 3. Capture Function Responses (Observation)
-            if part.function_response:
+            if resp:
                 step_data["type"] = "tool_output"
-                step_data["tool_name"] = part.function_response.name
+                step_data["tool_name"] = resp.name
                 # FIX: Convert MapComposite to standard dict
-                step_data["content"] = make_serializable(part.function_response.response)
+                step_data["content"] = make_serializable(resp.response)
                 
-            session_log["steps"].append(step_data)
+            add_step(step_data)
 
     # Save to JSON
     if not os.path.exists(LOG_DIR):
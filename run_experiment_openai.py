@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-import argparse, os, json, sqlite3, textwrap, sys, time, csv, re
+import argparse, os, json, sqlite3, textwrap, sys, time, csv, re, threading, atexit
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple, Set
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple, Set, FrozenSet
 
 # pip install openai
 from openai import OpenAI
@@ -39,42 +43,178 @@ def is_select_sql(sql: str) -> bool:
     s = sql.strip().lower()
     return s.startswith("select") or s.startswith("pragma")
 
-def run_sql(db_path: Path, sql: str, limit: int = 50) -> Dict[str, Any]:
+# With --sql_timeout, SQLite polls the deadline check every N VM instructions
+PROGRESS_STEPS = 100_000
+
+# Idle read-only connections per resolved DB path; concurrent tool calls each take their own.
+# LRU over DB paths: a folder sweep keeps only the most recent DBs' connections open.
+POOL_MAX_DBS = 8
+_POOL: "OrderedDict[str, List[sqlite3.Connection]]" = OrderedDict()
+_POOL_LOCK = threading.Lock()
+
+# PRAGMAs that take an argument but only read; any other "PRAGMA x = v" / "PRAGMA x(v)" would
+# change a pooled connection's state (case_sensitive_like, query_only, ...) for later trials
+_ARG_PRAGMAS = {"table_info", "table_xinfo", "table_list", "index_list", "index_info", "index_xinfo", "foreign_key_list"}
+
+def _authorize(action, arg1, arg2, db_name, trigger):
+    if action == sqlite3.SQLITE_PRAGMA and arg2 is not None and (arg1 or "").lower() not in _ARG_PRAGMAS:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+def _open_ro(db_key: str) -> sqlite3.Connection:
+    # mode=ro + query_only: evidence files are never written (no WAL switch, no journal)
+    # The module's per-connection statement cache (keyed by exact SQL text) lives as long as the pool
+    con = sqlite3.connect(Path(db_key).as_uri() + "?mode=ro", uri=True, check_same_thread=False, cached_statements=256)
+    for pragma in ("query_only=1", "temp_store=MEMORY", "mmap_size=268435456"):
+        con.execute(f"PRAGMA {pragma}")
+    con.set_authorizer(_authorize)
+    return con
+
+def _acquire(db_path: Path) -> Tuple[str, sqlite3.Connection]:
+    key = str(Path(db_path).resolve())
+    evicted: List[sqlite3.Connection] = []
+    with _POOL_LOCK:
+        idle = _POOL.setdefault(key, [])
+        _POOL.move_to_end(key)
+        while len(_POOL) > POOL_MAX_DBS:
+            evicted += _POOL.popitem(last=False)[1]
+        con = idle.pop() if idle else None
+    for old in evicted:
+        old.close()
+    return key, con if con is not None else _open_ro(key)
+
+def _release(key: str, con: sqlite3.Connection) -> None:
+    with _POOL_LOCK:
+        idle = _POOL.get(key)
+        if idle is not None:
+            idle.append(con)
+            return
+    con.close()  # its DB was evicted while the query ran
+
+@atexit.register
+def _close_pool() -> None:
+    with _POOL_LOCK:
+        for idle in _POOL.values():
+            for con in idle:
+                con.close()
+            idle.clear()
+
+# Successful results across all trials, LRU-evicted. Keyed by the DB file's identity
+# (path, mtime, size) and the exact final SQL, so a changed file never serves stale rows.
+# Pooled connections cannot carry PRAGMA state (see _authorize), so the key fully determines the result.
+RESULT_CACHE_SIZE = 4096
+_RESULT_CACHE: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def run_sql(db_path: Path, sql: str, limit: int = 50, timeout: float = 0) -> Dict[str, Any]:
     if not is_select_sql(sql):
         return {"ok": False, "error": "Only SELECT/PRAGMA statements are allowed."}
     if sql.strip().lower().startswith("select") and " limit " not in sql.lower():
         sql = sql.rstrip().rstrip(";") + f" LIMIT {limit};"
     try:
-        con = sqlite3.connect(str(db_path))
-        con.row_factory = sqlite3.Row
+        st = os.stat(db_path)
+        ckey = (str(Path(db_path).resolve()), st.st_mtime_ns, st.st_size, sql)
+    except OSError:
+        ckey = None
+    if ckey:
+        with _RESULT_CACHE_LOCK:
+            hit = _RESULT_CACHE.get(ckey)
+            if hit is not None:
+                _RESULT_CACHE.move_to_end(ckey)
+                return hit  # shared; callers only serialize it
+    result = _run_sql_uncached(db_path, sql, timeout)
+    if ckey and result["ok"]:
+        with _RESULT_CACHE_LOCK:
+            _RESULT_CACHE[ckey] = result
+            if len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+                _RESULT_CACHE.popitem(last=False)
+    return result
+
+def _run_sql_uncached(db_path: Path, sql: str, timeout: float = 0) -> Dict[str, Any]:
+    try:
+        key, con = _acquire(db_path)
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+    try:
+        if timeout > 0:
+            deadline = time.monotonic() + timeout
+            con.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+        else:
+            con.set_progress_handler(None, 0)  # pooled connection: drop any earlier deadline
         cur = con.cursor()
         cur.execute(sql)
-        if cur.description is None:
-            rows = cur.fetchall()
-            out = [[v for v in r] for r in rows]
-            return {"ok": True, "columns": [], "rows": out, "rowcount": len(out)}
-        cols = [d[0] for d in cur.description]
-        rows = cur.fetchall()
-        out = [[r[c] for c in cols] for r in rows]
+        # Plain tuples from the C layer; positional, so duplicate column names keep their own values
+        out = [list(r) for r in cur.fetchall()]
+        cols = [d[0] for d in cur.description] if cur.description is not None else []
         return {"ok": True, "columns": cols, "rows": out, "rowcount": len(out)}
+    except sqlite3.DatabaseError as e:
+        if str(e) == "not authorized":
+            return {"ok": False, "error": "PRAGMA assignments are not allowed."}
+        return {"ok": False, "error": str(e)}
     except Exception as e:
         return {"ok": False, "error": str(e)}
     finally:
-        try:
-            con.close()
-        except Exception:
-            pass
+        _release(key, con)
+
+# All tables and their columns in one statement (what inspect_schema runs)
+SCHEMA_SQL = ("SELECT m.name AS tbl, p.name AS col, p.type AS type, p.pk AS pk FROM sqlite_master AS m, pragma_table_info(m.name) AS p "
+              "WHERE m.type = 'table' ORDER BY m.name, p.cid")
+
+def inspect_schema(db_path: Path, timeout: float = 0) -> Dict[str, Any]:
+    res = run_sql(db_path, SCHEMA_SQL, limit=-1, timeout=timeout)
+    unreadable: Dict[str, str] = {}
+    if res["ok"]:
+        rows = res["rows"]
+    else:
+        # A single table that cannot be loaded (e.g. a virtual table whose module is missing)
+        # fails the join; go table by table and report those separately
+        names = run_sql(db_path, "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name", limit=-1, timeout=timeout)
+        if not names["ok"]:
+            return names
+        rows = []
+        for (tbl,) in names["rows"]:
+            info = run_sql(db_path, 'PRAGMA table_info("' + tbl.replace('"', '""') + '")', timeout=timeout)
+            if info["ok"]:
+                # table_info rows: cid, name, type, notnull, dflt_value, pk
+                rows.extend((tbl, r[1], r[2], r[5]) for r in info["rows"])
+            else:
+                unreadable[tbl] = info["error"]
+    tables: Dict[str, List[str]] = {}
+    for tbl, col, typ, pk in rows:
+        tables.setdefault(tbl, []).append(f"{col} {typ}".rstrip() + (" PK" if pk else ""))
+    out = {"ok": True, "tables": tables, "rowcount": len(tables)}
+    if unreadable:
+        out["unreadable"] = unreadable
+    return out
+
+DB_EXTS = {".db", ".sqlite", ".sqlite3"}
 
 def find_dbs(input_path: Path) -> List[Path]:
     if input_path.is_file():
         return [input_path]
-    exts = {".db", ".sqlite", ".sqlite3"}
+    # Same order as os.walk (a directory's files, then its subdirectories depth-first),
+    # but the extension is checked on DirEntry.name before any Path is built
     hits = []
-    for dp, _, fns in os.walk(input_path):
-        for fn in fns:
-            p = Path(dp) / fn
-            if p.suffix.lower() in exts:
-                hits.append(p)
+    stack = [str(input_path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError:
+            continue  # unreadable directory, skipped like os.walk does
+        subdirs = []
+        for e in entries:
+            try:
+                is_dir = e.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Symlinked directories are not descended into (os.walk's followlinks=False)
+                if not e.is_symlink():
+                    subdirs.append(e.path)
+            elif os.path.splitext(e.name)[1].lower() in DB_EXTS:
+                hits.append(Path(e.path))
+        stack.extend(reversed(subdirs))
     return hits
 
 # ---------- Prompts ----------
@@ -83,7 +223,12 @@ def load_prompt_file(path: Optional[str], fallback: str) -> str:
         return Path(path).read_text(encoding="utf-8")
     return fallback
 
-def make_system_prompt(workflow_text: str) -> str:
+# Only with --schema_tool, so the default prompts stay the ones under test
+SCHEMA_TOOL_HINT = ("Call inspect_schema first: it returns every table with its columns in one step, "
+                    "replacing separate sqlite_master / PRAGMA table_info queries.\n")
+
+def make_system_prompt(workflow_text: str, schema_tool: bool = False) -> str:
+    hint = SCHEMA_TOOL_HINT if schema_tool else ""
     return textwrap.dedent(f"""\
     You are an agent that must query a local SQLite database via a tool.
     Respond concisely. Return a JSON object with this schema:
@@ -93,7 +238,7 @@ def make_system_prompt(workflow_text: str) -> str:
       ]
     }}
     If nothing is found, return {{"findings":[]}}.
-
+    {hint}
     {workflow_text}
     """)
 
@@ -122,27 +267,39 @@ def read_gt_csv(path: Path) -> List[Dict[str, Any]]:
 def normalize_str(x: Any) -> str:
     return "" if x is None else str(x).strip()
 
-def load_ground_truth_for_db(gt_file: Path, entity_type: str) -> Set[Tuple[str, str, str]]:
+@lru_cache(maxsize=None)
+def _gt_triples_by_entity(path_str: str, mtime_ns: int) -> Dict[str, FrozenSet[Tuple[str, str, str]]]:
+    # One parse per GT file (and version): every entity's triples in a single pass over the rows
+    gt_file = Path(path_str)
     if gt_file.suffix.lower() == ".json":
         data = read_gt_json(gt_file)
-    elif gt_file.suffix.lower() == ".csv":
-        data = read_gt_csv(gt_file)
     else:
-        return set()
+        data = read_gt_csv(gt_file)
 
-    triples = set()
+    by_entity: Dict[str, Set[Tuple[str, str, str]]] = {}
     for r in data:
         et = normalize_str(r.get("entity_type") or r.get("EntityType")).lower()
-        if et != entity_type:
-            continue
         val = normalize_str(r.get("value") or r.get("Value"))
         table = normalize_str(r.get("table") or r.get("Table"))
         rowid = normalize_str(r.get("rowid") or r.get("RowID") or r.get("row_id") or r.get("pk"))
         if val and table and rowid:
-            triples.add((val, table, rowid))
-    return triples
+            by_entity.setdefault(et, set()).add((val, table, rowid))
+    return {et: frozenset(triples) for et, triples in by_entity.items()}
+
+def load_ground_truth_for_db(gt_file: Path, entity_type: str) -> FrozenSet[Tuple[str, str, str]]:
+    # Shared across trials, hence frozen
+    if gt_file.suffix.lower() not in (".json", ".csv"):
+        return frozenset()
+    return _gt_triples_by_entity(str(gt_file), gt_file.stat().st_mtime_ns).get(entity_type, frozenset())
 
+@lru_cache(maxsize=None)
+def _gt_candidates(gt_dir: Path) -> List[Path]:
+    # One walk of gt_dir per run, in glob order, shared by every DB lookup
+    return [p for p in gt_dir.glob("**/*") if p.is_file() and p.suffix.lower() in {".json", ".csv"}]
+
+@lru_cache(maxsize=None)
 def find_gt_file_for_db(gt_dir: Optional[Path], gt_manifest: Optional[Path], db_path: Path) -> Optional[Path]:
+    # Memoized: every (entity, workflow, trial) of a DB resolves to the same file
     # 1) Manifest CSV override
     if gt_manifest and gt_manifest.exists():
         with open(gt_manifest, newline="", encoding="utf-8") as f:
@@ -154,13 +311,11 @@ def find_gt_file_for_db(gt_dir: Optional[Path], gt_manifest: Optional[Path], db_
     if not gt_dir or not gt_dir.exists():
         return None
     stem = db_path.name
-    candidates = []
-    for p in gt_dir.glob("**/*"):
-        if p.is_file() and p.suffix.lower() in {".json", ".csv"} and stem in p.name:
-            candidates.append(p)
+    candidates = [p for p in _gt_candidates(gt_dir) if stem in p.name]
     # prefer files with 'ground_truth' in name
-    candidates.sort(key=lambda p: (("ground_truth" not in p.name.lower()), len(p.name)))
-    return candidates[0] if candidates else None
+    if not candidates:
+        return None
+    return min(candidates, key=lambda p: (("ground_truth" not in p.name.lower()), len(p.name)))
 
 # ---------- Behavior metrics (RQ1 proxies) ----------
 RE_TABLE = re.compile(r"\bfrom\s+([`\"[]?\w+[`\"[]?)", re.I)
@@ -170,28 +325,32 @@ def table_name_from_sql(sql: str) -> Optional[str]:
         return m.group(1).strip("`\"[]")
     return None
 
+# Same substrings as before, matched case-insensitively in one pass (no lowercased copy)
+RE_SCHEMA = re.compile(r"sqlite_master|pragma table_info", re.I)
+# simple signals: LIKE/INSTR/LENGTH/BETWEEN/DATE/DATETIME and ISO patterns
+RE_VERIFY = re.compile(r" like | glob | instr\(| length\(| between | datetime\(| date\(|yyyy-mm-dd", re.I)
+
 def is_schema_explore(sql: str) -> bool:
-    s = (sql or "").lower()
-    return "sqlite_master" in s or "pragma table_info" in s
+    return RE_SCHEMA.search(sql or "") is not None
 
 def is_verification_like(sql: str) -> bool:
-    s = (sql or "").lower()
-    # simple signals: LIKE/INSTR/LENGTH/BETWEEN/DATE/DATETIME and ISO patterns
-    return any(k in s for k in [" like ", " glob ", " instr(", " length(", " between ", " datetime(", " date("]) or "yyyy-mm-dd" in s
+    return RE_VERIFY.search(sql or "") is not None
 
 def count_self_corrections(sqls: List[str]) -> int:
     # very simple heuristic: repeating selects on same table where later query adds WHERE or extra constraints
     corrections = 0
-    last_by_table: Dict[str, str] = {}
+    # table -> (lowercased SQL, original length) of the last query on it; each SQL is lowercased once
+    last_by_table: Dict[str, Tuple[str, int]] = {}
     for s in sqls:
         tbl = table_name_from_sql(s or "")
         if not tbl:
             continue
         prev = last_by_table.get(tbl)
-        cur_has_where = " where " in (s or "").lower()
-        if prev and cur_has_where and len(s) > len(prev) and (prev.lower() in s.lower()):
+        low = s.lower()
+        cur_has_where = " where " in low
+        if prev and cur_has_where and len(s) > prev[1] and (prev[0] in low):
             corrections += 1
-        last_by_table[tbl] = s
+        last_by_table[tbl] = (low, len(s))
     return corrections
 
 # ---------- Scoring ----------
@@ -204,11 +363,12 @@ def score_run(findings: List[Dict[str, str]], gt_set: Set[Tuple[str, str, str]])
         if val and table and rowid:
             preds.add((val, table, rowid))
 
-    tp = len(preds & gt_set)
-    fp = len(preds - gt_set)
-    fn = len(gt_set - preds)
     total_pred = len(preds)
     total_gt = len(gt_set)
+    # One intersection (set.intersection iterates the smaller side); FP/FN follow from the sizes
+    tp = len(preds.intersection(gt_set))
+    fp = total_pred - tp
+    fn = total_gt - tp
 
     precision = (tp / (tp + fp)) if (tp + fp) > 0 else 0.0
     recall = (tp / (tp + fn)) if (tp + fn) > 0 else 0.0
@@ -224,6 +384,11 @@ def score_run(findings: List[Dict[str, str]], gt_set: Set[Tuple[str, str, str]])
         "provenance_completeness": round(provenance_completeness, 4),
     }
 
+# Regex Patterns for W2
+RE_W2_EMAIL = re.compile(r"[^@]+@[^@]+\.[^@]+")
+UNIX_SEC_MIN = 946684800   # Year 2000
+UNIX_SEC_MAX = 4102444800  # Year 2100
+
 def validate_constraints(findings: List[Dict], workflow: str, entity_type: str) -> Tuple[List[Dict], List[str]]:
     """
     Enforces the 'Architectural Constraints' described in the paper.
@@ -231,11 +396,6 @@ def validate_constraints(findings: List[Dict], workflow: str, entity_type: str)
     """
     valid = []
     errors = []
-    
-    # Regex Patterns for W2
-    EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
-    UNIX_SEC_MIN = 946684800   # Year 2000
-    UNIX_SEC_MAX = 4102444800  # Year 2100
 
     for f in findings:
         val = str(f.get("value", "")).strip()
@@ -246,7 +406,7 @@ def validate_constraints(findings: List[Dict], workflow: str, entity_type: str)
         if workflow == "w2":
             if entity_type == "identifier":
                 # Example: If it looks like an email, strictly enforce regex
-                if "@" in val and not EMAIL_REGEX.match(val):
+                if "@" in val and not RE_W2_EMAIL.match(val):
                     errors.append(f"W2 Violation: Invalid email format '{val}'")
                     continue
             elif entity_type == "temporal":
@@ -272,6 +432,168 @@ def validate_constraints(findings: List[Dict], workflow: str, entity_type: str)
     return valid, errors
 
 
+# ---------- One trial ----------
+def compact_observation(result: Dict[str, Any]) -> str:
+    # Older row results shrink to shape + first row; errors and schema listings are short or still needed
+    if not result.get("ok") or "rows" not in result:
+        return json.dumps(result)[:8000]
+    return json.dumps({"ok": True, "rowcount": result["rowcount"], "columns": result["columns"],
+                       "sample": result["rows"][:1], "compacted": True})[:8000]
+
+def run_trial(client: OpenAI, args: argparse.Namespace, tool_def: List[Dict[str, Any]], db: Path, entity: str, wf: str,
+              trial: int, system_prompt: str, user_prompt: str,
+              gt_dir: Optional[Path], gt_manifest: Optional[Path]) -> Optional[Dict[str, Any]]:
+    # Runs the tool loop for one (db, entity, workflow, trial); returns the record, or None if it never finalized
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+    total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_prompt_tokens": 0}
+    tool_calls_used = 0
+    tool_log: List[Dict[str, Any]] = []
+    issued_sqls: List[str] = []
+    # (message, result) of tool replies still sent verbatim; only tracked with --keep_tool_obs
+    verbatim_obs: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+
+    # --- REPLACEMENT BLOCK START ---
+    reasoning_steps = 0  # NEW: Initialize counter for I_plan metric
+
+    tool_names = {t["function"]["name"] for t in tool_def}  # only advertised tools are executed
+    finalizing = False  # tool budget spent: the next turn may only answer
+
+    # One iteration past max_steps, used only for the forced finalize turn when the tool budget
+    # ran out on the last step
+    for step in range(args.max_steps + 1):
+        if step == args.max_steps and not finalizing:
+            break
+        resp = client.chat.completions.create(
+            model=args.model,
+            temperature=0,
+            max_tokens=350,
+            messages=messages,
+            tools=tool_def,
+            tool_choice="none" if finalizing else "auto",
+            seed=args.seed
+        )
+        choice = resp.choices[0]
+        total_usage["prompt_tokens"] += getattr(resp.usage, "prompt_tokens", 0) or 0
+        total_usage["completion_tokens"] += getattr(resp.usage, "completion_tokens", 0) or 0
+        total_usage["total_tokens"] += getattr(resp.usage, "total_tokens", 0) or 0
+        # Prompt-prefix cache hits (static system/user prompt first, growing history after)
+        details = getattr(resp.usage, "prompt_tokens_details", None)
+        total_usage["cached_prompt_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+        # NEW: Capture "Thinking" logic for Planning Intensity (I_plan)
+        content = choice.message.content
+        if content and len(content.strip()) > 10:
+            reasoning_steps += 1
+
+        if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
+            calls = [tc for tc in choice.message.tool_calls if tc.function.name in tool_names]
+            # inspect_schema is logged as the SQL it runs, so it counts as schema exploration
+            sqls = [SCHEMA_SQL if tc.function.name == "inspect_schema" else json.loads(tc.function.arguments).get("sql", "")
+                    for tc in calls]
+            results = []
+            # All SQL of one turn runs concurrently; map() keeps results aligned with calls
+            if calls:
+                with ThreadPoolExecutor(max_workers=len(calls)) as ex:
+                    results = list(ex.map(
+                        lambda tc, q: inspect_schema(db, args.sql_timeout) if tc.function.name == "inspect_schema"
+                        else run_sql(db, q, limit=args.max_rows, timeout=args.sql_timeout),
+                        calls, sqls))
+                # One assistant message carrying every call, then one tool reply per call id
+                messages.append({"role": "assistant", "tool_calls": calls})
+            for tc, sql, result in zip(calls, sqls, results):
+                tool_calls_used += 1
+                issued_sqls.append(sql)
+                tool_log.append({
+                    "sql": sql, "ok": result.get("ok"),
+                    "rowcount": result.get("rowcount", 0),
+                    "error": result.get("error")
+                })
+                tool_msg = {
+                    "role": "tool",
+                    "tool_call_id": tc.id,
+                    "name": tc.function.name,
+                    "content": json.dumps(result)[:8000]
+                }
+                messages.append(tool_msg)
+                if args.keep_tool_obs > 0:
+                    verbatim_obs.append((tool_msg, result))
+
+            # Every turn resends the whole history: shrink all but the newest K observations
+            while args.keep_tool_obs > 0 and len(verbatim_obs) > args.keep_tool_obs:
+                tool_msg, result = verbatim_obs.pop(0)
+                tool_msg["content"] = compact_observation(result)
+
+            if tool_calls_used >= args.max_steps and not finalizing:
+                messages.append({"role": "user", "content": "Finalize now with the JSON findings only."})
+                finalizing = True
+        else:
+            # --- FINALIZATION LOGIC (UPDATED) ---
+            content = choice.message.content or ""
+            findings = {"findings": []}
+            try:
+                start = content.find("{"); end = content.rfind("}")
+                if start != -1 and end != -1:
+                    raw_findings = json.loads(content[start:end+1]).get("findings", [])
+
+                    # NEW: Enforce Architectural Constraints (W2/W3)
+                    final_findings, constraint_errs = validate_constraints(raw_findings, wf, entity)
+
+                    # Log constraint violations if any (optional, printed to stderr for debug)
+                    if constraint_errs:
+                        print(f"  [Constraint Violation] {len(constraint_errs)} items rejected in {wf}", file=sys.stderr)
+
+                    findings = {"findings": final_findings}
+            except Exception:
+                findings = {"findings": []}
+
+            # Behavior metrics (RQ1 proxies)
+            sql_calls = len(issued_sqls)
+            schema_exploration = sum(1 for s in issued_sqls if is_schema_explore(s))
+            verification_calls = sum(1 for s in issued_sqls if is_verification_like(s))
+            verification_ratio = (verification_calls / sql_calls) if sql_calls > 0 else 0.0
+            self_corr = count_self_corrections(issued_sqls)
+
+            # NEW: Calculate Planning Intensity
+            total_ops = reasoning_steps + tool_calls_used
+            i_plan = (reasoning_steps / total_ops) if total_ops > 0 else 0.0
+
+            # Optional scoring if GT available
+            gt_file = find_gt_file_for_db(gt_dir, gt_manifest, db) if (gt_dir or gt_manifest) else None
+            metrics = None
+            if gt_file:
+                gt_set = load_ground_truth_for_db(gt_file, entity)
+                metrics = score_run(findings.get("findings", []), gt_set)
+
+            record = {
+                "db": str(db),
+                "entity_type": entity,
+                "workflow": wf,
+                "model": args.model,
+                "trial": trial,
+                "timestamp": int(time.time()),
+                "usage": total_usage,
+                "tool_calls": tool_calls_used,
+                "tool_log": tool_log,
+                "behavior": {
+                    "sql_calls": sql_calls,
+                    "schema_exploration": schema_exploration,
+                    "verification_calls": verification_calls,
+                    "verification_ratio": round(verification_ratio, 4),
+                    "self_corrections": self_corr,
+                    "planning_intensity": round(i_plan, 2) # NEW: Added to output
+                },
+                "metrics": metrics,
+                "result": findings
+            }
+            return record
+    # --- REPLACEMENT BLOCK END ---
+    return None
+
+
 # ---------- Main ----------
 def main():
     ap = argparse.ArgumentParser(description="Run agentic digital evidence experiments with OpenAI (with optional scoring).")
@@ -281,15 +603,22 @@ def main():
     ap.add_argument("--model", default="gpt-4o-mini", help="OpenAI model (gpt-4o-mini is low cost)")
     ap.add_argument("--max_steps", type=int, default=5, help="Max tool-call iterations per trial")
     ap.add_argument("--max_rows", type=int, default=50, help="Max rows returned per SQL call")
+    ap.add_argument("--sql_timeout", type=float, default=0, help="Interrupt a tool query after this many seconds (0 = no limit)")
+    ap.add_argument("--keep_tool_obs", type=int, default=0,
+                    help="Keep only the last K tool results verbatim in the conversation; older ones are summarized (0 = keep all)")
     ap.add_argument("--trials", type=int, default=1, help="Trials per (DB×Entity×Workflow)")
     ap.add_argument("--seed", type=int, default=None, help="Optional seed")
     ap.add_argument("--outdir", default="runs_out", help="Output directory")
+    ap.add_argument("--schema_tool", action="store_true",
+                    help="Also offer the inspect_schema meta-tool and suggest it in the system prompt (changes the tested condition)")
+    ap.add_argument("--jsonl", action="store_true", help="Append trial records to one <db>.jsonl per database instead of one JSON file per trial")
     ap.add_argument("--prompt_w1", default=None, help="Path to prompt_w1.txt")
     ap.add_argument("--prompt_w2", default=None, help="Path to prompt_w2.txt")
     ap.add_argument("--prompt_w3", default=None, help="Path to prompt_w3.txt")
     # scoring inputs
     ap.add_argument("--gt_dir", default=None, help="Directory with ground truth files (JSON/CSV)")
     ap.add_argument("--gt_manifest", default=None, help="CSV with columns: db,gt_path")
+    ap.add_argument("--concurrency", type=int, default=1, help="Trials run concurrently (default 1: sequential)")
     args = ap.parse_args()
 
     # Load workflow prompts (your files if provided)
@@ -300,6 +629,9 @@ def main():
 
     entities = [e.strip().lower() for e in args.entities.split(",") if e.strip()]
     workflows = [w.strip().lower() for w in args.workflows.split(",") if w.strip()]
+    # Prompts depend only on workflow / entity: build each once, not per (db, trial)
+    SYSTEM_PROMPTS = {wf: make_system_prompt(WF.get(wf, w1), args.schema_tool) for wf in workflows}
+    USER_PROMPTS = {entity: make_user_prompt(entity) for entity in entities}
     outdir = Path(args.outdir); outdir.mkdir(parents=True, exist_ok=True)
     metrics_csv = outdir / "metrics_summary.csv"
     if not metrics_csv.exists():
@@ -332,161 +664,78 @@ def main():
             }
         }
     }]
+    if args.schema_tool:
+        tool_def.append({
+            "type": "function",
+            "function": {
+                "name": "inspect_schema",
+                "description": "Return all tables of the active SQLite DB with their columns (name, type, PK) in one call.",
+                "parameters": {"type": "object", "properties": {}}
+            }
+        })
 
     dbs = find_dbs(Path(args.input))
     if not dbs:
         print("No databases found.", file=sys.stderr)
         sys.exit(2)
 
+    # Every (db, entity, workflow, trial) is an independent conversation
+    jobs = []
     for db in dbs:
         for entity in entities:
             for wf in workflows:
-                wf_text = WF.get(wf, w1)
-                system_prompt = make_system_prompt(wf_text)
-                user_prompt = make_user_prompt(entity)
-
                 for trial in range(1, args.trials + 1):
-                    messages = [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-
-                    total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                    tool_calls_used = 0
-                    tool_log: List[Dict[str, Any]] = []
-                    issued_sqls: List[str] = []
-
-                   # --- REPLACEMENT BLOCK START ---
-                    reasoning_steps = 0  # NEW: Initialize counter for I_plan metric
-
-                    for step in range(args.max_steps):
-                        resp = client.chat.completions.create(
-                            model=args.model,
-                            temperature=0,
-                            max_tokens=350,
-                            messages=messages,
-                            tools=tool_def,
-                            tool_choice="auto",
-                            seed=args.seed
-                        )
-                        choice = resp.choices[0]
-                        total_usage["prompt_tokens"] += getattr(resp.usage, "prompt_tokens", 0) or 0
-                        total_usage["completion_tokens"] += getattr(resp.usage, "completion_tokens", 0) or 0
-                        total_usage["total_tokens"] += getattr(resp.usage, "total_tokens", 0) or 0
-
-                        # NEW: Capture "Thinking" logic for Planning Intensity (I_plan)
-                        content = choice.message.content
-                        if content and len(content.strip()) > 10:
-                            reasoning_steps += 1
-
-                        if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
-                            # (This section remains identical to your original code)
-                            for tc in choice.message.tool_calls:
-                                if tc.function.name == "execute_sqlite_query":
-                                    sql = json.loads(tc.function.arguments).get("sql", "")
-                                    result = run_sql(db, sql, limit=args.max_rows)
-                                    tool_calls_used += 1
-                                    issued_sqls.append(sql)
-                                    tool_log.append({
-                                        "sql": sql, "ok": result.get("ok"),
-                                        "rowcount": result.get("rowcount", 0),
-                                        "error": result.get("error")
-                                    })
-                                    messages.append({"role": "assistant", "tool_calls": [tc]})
-                                    messages.append({
-                                        "role": "tool",
-                                        "tool_call_id": tc.id,
-                                        "name": "execute_sqlite_query",
-                                        "content": json.dumps(result)[:8000]
-                                    })
-                            
-                            if tool_calls_used >= args.max_steps:
-                                messages.append({"role": "user", "content": "Finalize now with the JSON findings only."})
-                                continue
-                        else:
-                            # --- FINALIZATION LOGIC (UPDATED) ---
-                            content = choice.message.content or ""
-                            findings = {"findings": []}
-                            try:
-                                start = content.find("{"); end = content.rfind("}")
-                                if start != -1 and end != -1:
-                                    raw_findings = json.loads(content[start:end+1]).get("findings", [])
-                                    
-                                    # NEW: Enforce Architectural Constraints (W2/W3)
-                                    final_findings, constraint_errs = validate_constraints(raw_findings, wf, entity)
-                                    
-                                    # Log constraint violations if any (optional, printed to stderr for debug)
-                                    if constraint_errs:
-                                        print(f"  [Constraint Violation] {len(constraint_errs)} items rejected in {wf}", file=sys.stderr)
-                                    
-                                    findings = {"findings": final_findings}
-                            except Exception:
-                                findings = {"findings": []}
-
-                            # Behavior metrics (RQ1 proxies)
-                            sql_calls = len(issued_sqls)
-                            schema_exploration = sum(1 for s in issued_sqls if is_schema_explore(s))
-                            verification_calls = sum(1 for s in issued_sqls if is_verification_like(s))
-                            verification_ratio = (verification_calls / sql_calls) if sql_calls > 0 else 0.0
-                            self_corr = count_self_corrections(issued_sqls)
-                            
-                            # NEW: Calculate Planning Intensity
-                            total_ops = reasoning_steps + tool_calls_used
-                            i_plan = (reasoning_steps / total_ops) if total_ops > 0 else 0.0
-
-                            # Optional scoring if GT available
-                            gt_file = find_gt_file_for_db(gt_dir, gt_manifest, db) if (gt_dir or gt_manifest) else None
-                            metrics = None
-                            if gt_file:
-                                gt_set = load_ground_truth_for_db(gt_file, entity)
-                                metrics = score_run(findings.get("findings", []), gt_set)
-
-                            record = {
-                                "db": str(db),
-                                "entity_type": entity,
-                                "workflow": wf,
-                                "model": args.model,
-                                "trial": trial,
-                                "timestamp": int(time.time()),
-                                "usage": total_usage,
-                                "tool_calls": tool_calls_used,
-                                "tool_log": tool_log,
-                                "behavior": {
-                                    "sql_calls": sql_calls,
-                                    "schema_exploration": schema_exploration,
-                                    "verification_calls": verification_calls,
-                                    "verification_ratio": round(verification_ratio, 4),
-                                    "self_corrections": self_corr,
-                                    "planning_intensity": round(i_plan, 2) # NEW: Added to output
-                                },
-                                "metrics": metrics,
-                                "result": findings
-                            }
-
-                            # Save JSON
-                            relname = db.name
-                            outname = f"{relname}.{entity}.{wf}.trial{trial}.json"
-                            (outdir / outname).write_text(json.dumps(record, ensure_ascii=False, indent=2), encoding="utf-8")
-
-                            # (CSV saving block remains the same...)
-                            if metrics:
-                                with open(metrics_csv, "a", newline="", encoding="utf-8") as f:
-                                    w = csv.writer(f)
-                                    w.writerow([
-                                        str(db), entity, wf, trial, args.model,
-                                        metrics["TP"], metrics["FP"], metrics["FN"],
-                                        metrics["total_pred"], metrics["total_gt"],
-                                        metrics["precision"], metrics["recall"],
-                                        metrics["hallucination_rate"], metrics["provenance_completeness"],
-                                        sql_calls, schema_exploration, verification_calls,
-                                        round(verification_ratio,4), self_corr,
-                                        total_usage["total_tokens"]
-                                    ])
-
-                            print(f"Wrote {outname} | PlanInt={round(i_plan,2)} | " +
-                                  (f"P={metrics['precision']} R={metrics['recall']}" if metrics else "(no GT)"))
-                            break
-                    # --- REPLACEMENT BLOCK END ---
+                    jobs.append((db, entity, wf, trial, SYSTEM_PROMPTS[wf], USER_PROMPTS[entity]))
+
+    # Trials are network-bound, so threads overlap their API round trips. map() yields in job
+    # order, and all files are written here on the main thread.
+    # One append handle for the whole run; line-buffered so each finished trial's row is on disk
+    with open(metrics_csv, "a", newline="", encoding="utf-8", buffering=1) as metrics_f, ExitStack() as stack:
+        metrics_writer = csv.writer(metrics_f)
+        jsonl_files: Dict[str, Any] = {}  # --jsonl: db name -> open append handle
+        run_job = lambda job: run_trial(client, args, tool_def, *job, gt_dir, gt_manifest)
+        if args.concurrency > 1:
+            pool = ThreadPoolExecutor(max_workers=args.concurrency)
+            # On an error, queued trials are dropped instead of running (and billing) during shutdown
+            stack.callback(pool.shutdown, wait=True, cancel_futures=True)
+            records = pool.map(run_job, jobs)
+        else:
+            # Sequential: a failing trial stops the run right there
+            records = map(run_job, jobs)
+        for (db, entity, wf, trial, _, _), record in zip(jobs, records):
+            if record is None:
+                continue
+            behavior, metrics, total_usage = record["behavior"], record["metrics"], record["usage"]
+
+            # Save JSON
+            relname = db.name
+            if args.jsonl:
+                # One line per trial in a per-DB file, opened once, instead of a file per trial
+                outname = f"{relname}.jsonl"
+                f = jsonl_files.get(relname)
+                if f is None:
+                    f = jsonl_files[relname] = stack.enter_context(open(outdir / outname, "a", encoding="utf-8"))
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            else:
+                outname = f"{relname}.{entity}.{wf}.trial{trial}.json"
+                (outdir / outname).write_text(json.dumps(record, ensure_ascii=False, indent=2), encoding="utf-8")
+
+            # (CSV saving block remains the same...)
+            if metrics:
+                metrics_writer.writerow([
+                    str(db), entity, wf, trial, args.model,
+                    metrics["TP"], metrics["FP"], metrics["FN"],
+                    metrics["total_pred"], metrics["total_gt"],
+                    metrics["precision"], metrics["recall"],
+                    metrics["hallucination_rate"], metrics["provenance_completeness"],
+                    behavior["sql_calls"], behavior["schema_exploration"], behavior["verification_calls"],
+                    behavior["verification_ratio"], behavior["self_corrections"],
+                    total_usage["total_tokens"]
+                ])
+
+            label = f"{outname} ({entity}.{wf}.trial{trial})" if args.jsonl else outname
+            print(f"Wrote {label} | PlanInt={behavior['planning_intensity']} | " +
+                  (f"P={metrics['precision']} R={metrics['recall']}" if metrics else "(no GT)"))
 
 if __name__ == "__main__":
     main()